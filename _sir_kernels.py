@@ -0,0 +1,218 @@
+"""
+Kernels of the SIR models, compiled with numba if it is installed.
+
+The Gillespie, tau-leaping and Runge-Kutta kernels can also be compiled ahead of time into the extension module sir_kernels
+by running this file, which removes the JIT compilation at the first call:
+
+    python _sir_kernels.py
+"""
+import math
+import random
+import numpy as np
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        """
+        Replacement for numba's njit decorator when numba is not installed. Leaves the function uncompiled.
+        """
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+
+# Changes of S, I and R by event 1 (single infection, index 0) and event 2 (single recovery, index 1)
+DS = (-1, 0)
+DI = (1, -1)
+DR = (0, 1)
+
+# Fast math flags of the Gillespie kernels. Leaves out 'nnan' and 'ninf', as the kernels rely on infinite waiting times
+GILLESPIE_FASTMATH = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+
+@njit(cache=True)
+def seed(s):
+    """
+    Seeds the random number generators used inside the compiled kernels. These are separate from those of Python's random
+    module and numpy, so seeding the latter from Python has no effect on compiled kernels.
+    """
+    random.seed(s)
+    np.random.seed(s)
+
+
+@njit(cache=True, fastmath=GILLESPIE_FASTMATH)
+def gillespie_fill(S, I, R, beta, gamma, t0, tmax, t_arr, SIR):
+    """
+    Compiled Gillespie loop of the stochastic SIR model. Starts at t = t0 with the given S, I and R and runs
+    until tmax is reached, the infected population becomes zero or the given arrays are full.
+    Writes the times into t_arr and S, I and R into the columns of SIR. Returns the number of stored events.
+    """
+    cap = len(t_arr)
+
+    # N does not change, as there are no births or deaths
+    N = S + I + R
+    inv_N = 1.0 / N
+    t = t0
+    t_arr[0] = t
+    SIR[0, 0], SIR[0, 1], SIR[0, 2] = S, I, R
+    n = 1
+
+    while t < tmax and I > 0 and n < cap:
+
+        # Probabilities of event 1 (single infection) and event 2 (single recovery)
+        a1 = beta * S * I * inv_N
+        a2 = gamma * I
+
+        # Exponentially distributed waiting times of both events. 1 - u lies in (0, 1], so the log is finite.
+        # An event with probability zero never happens, e.g. no infection can happen anymore if S is zero
+        t_inf = -math.log(1.0 - random.random()) / a1 if a1 > 0 else np.inf
+        t_rec = -math.log(1.0 - random.random()) / a2 if a2 > 0 else np.inf
+
+        # Stop if neither event can happen anymore
+        if t_inf == np.inf and t_rec == np.inf:
+            break
+
+        # The event with the shortest waiting time happens first. Selected without branches, so it compiles to
+        # conditional moves instead of a hard to predict jump
+        k = 0 if t_inf < t_rec else 1
+        t += min(t_inf, t_rec)
+        S += DS[k]
+        I += DI[k]
+        R += DR[k]
+
+        t_arr[n] = t
+        SIR[n, 0], SIR[n, 1], SIR[n, 2] = S, I, R
+        n += 1
+
+    return n
+
+
+@njit(cache=True, fastmath=GILLESPIE_FASTMATH)
+def gillespie(S, I, R, beta, gamma, t0, tmax, cap):
+    """
+    Runs a single Gillespie simulation from t0 in preallocated arrays with room for cap events.
+    Returns an array with the times and an array with S, I and R in its columns, trimmed to the number of
+    stored events.
+    """
+    t_arr = np.empty(cap, np.float64)
+    SIR = np.empty((cap, 3), np.int32)
+    n = gillespie_fill(S, I, R, beta, gamma, t0, tmax, t_arr, SIR)
+    return t_arr[:n], SIR[:n]
+
+
+@njit(cache=True)
+def poisson(lam):
+    """
+    Draws a number from a Poisson distribution with mean lam. Small means, as typical for a single leap, use Knuth's
+    method of multiplying uniform numbers until their product drops below exp(-lam). Larger means use numpy's sampler.
+    """
+    if lam >= 30.0:
+        return np.random.poisson(lam)
+
+    L = math.exp(-lam)
+    k = 0
+    p = random.random()
+    while p > L:
+        k += 1
+        p *= random.random()
+    return k
+
+
+@njit(cache=True)
+def tau_leap(S, I, R, beta, gamma, t0, tmax, tau, cap):
+    """
+    Compiled tau-leaping loop of the stochastic SIR model with a fixed leap size tau. Starts at t = t0 with the given
+    S, I and R and runs until tmax is reached, the infected population becomes zero or cap leaps are stored.
+    Returns an array with the times and an array with S, I and R in its columns, trimmed to the number of stored leaps.
+    """
+    t_arr = np.empty(cap, np.float64)
+    SIR = np.empty((cap, 3), np.int32)
+
+    # N does not change, as there are no births or deaths
+    inv_N = 1.0 / (S + I + R)
+    t = t0
+    t_arr[0] = t
+    SIR[0, 0], SIR[0, 1], SIR[0, 2] = S, I, R
+    n = 1
+
+    while t < tmax and I > 0 and n < cap:
+
+        # Number of infections and recoveries during this leap, clipped so no subpopulation becomes negative
+        k1 = min(poisson(beta * S * I * inv_N * tau), S)
+        k2 = min(poisson(gamma * I * tau), I)
+
+        S -= k1
+        I += k1 - k2
+        R += k2
+        t += tau
+
+        t_arr[n] = t
+        SIR[n, 0], SIR[n, 1], SIR[n, 2] = S, I, R
+        n += 1
+
+    return t_arr[:n], SIR[:n]
+
+
+@njit(cache=True, parallel=True)
+def ensemble(S, I, R, beta, gamma, t0, tmax, n_reps, cap):
+    """
+    Runs n_reps independent Gillespie simulations in parallel, each in its own row of the output arrays.
+    Returns the times, the dynamics and the number of stored events of all replicates.
+    """
+    out_t = np.empty((n_reps, cap), np.float64)
+    out_SIR = np.empty((n_reps, cap, 3), np.int32)
+    out_len = np.empty(n_reps, np.int64)
+
+    for r in prange(n_reps):
+        out_len[r] = gillespie_fill(S, I, R, beta, gamma, t0, tmax, out_t[r], out_SIR[r])
+
+    return out_t, out_SIR, out_len
+
+
+@njit(cache=True, fastmath=True)
+def derivatives(S, I, beta, gamma):
+    """
+    Calculates the time derivatives of S, I and R in the continuous SIR model as scalars.
+    """
+    dS = - beta * S * I
+    dI = beta * S * I - gamma * I
+    dR = gamma * I
+    return dS, dI, dR
+
+
+@njit(cache=True, fastmath=True)
+def rk4(sir, dt, beta, gamma, n):
+    """
+    Compiled 4th order Runge-Kutta loop of the continuous SIR model. Fills rows 1 to n - 1 of sir in place,
+    starting from the values in row 0.
+    """
+    for i in range(n - 1):
+        S, I, R = sir[i, 0], sir[i, 1], sir[i, 2]
+
+        k1s, k1i, k1r = derivatives(S, I, beta, gamma)
+        k2s, k2i, k2r = derivatives(S + dt * k1s / 2., I + dt * k1i / 2., beta, gamma)
+        k3s, k3i, k3r = derivatives(S + dt * k2s / 2., I + dt * k2i / 2., beta, gamma)
+        k4s, k4i, k4r = derivatives(S + dt * k3s, I + dt * k3i, beta, gamma)
+
+        sir[i+1, 0] = S + dt * (k1s + 2 * k2s + 2 * k3s + k4s) / 6
+        sir[i+1, 1] = I + dt * (k1i + 2 * k2i + 2 * k3i + k4i) / 6
+        sir[i+1, 2] = R + dt * (k1r + 2 * k2r + 2 * k3r + k4r) / 6
+
+        # The derivatives sum to zero, so N does not change
+        sir[i+1, 3] = sir[i, 3]
+
+
+if __name__ == '__main__':
+    from numba.pycc import CC
+
+    cc = CC('sir_kernels')
+    cc.export('gillespie', 'Tuple((f8[:], i4[:, :]))(i8, i8, i8, f8, f8, f8, f8, i8)')(gillespie.py_func)
+    cc.export('tau_leap', 'Tuple((f8[:], i4[:, :]))(i8, i8, i8, f8, f8, f8, f8, f8, i8)')(tau_leap.py_func)
+    cc.export('seed', 'void(i8)')(seed.py_func)
+    cc.export('rk4', 'void(f8[:, :], f8, f8, f8, i8)')(rk4.py_func)
+    cc.compile()
@@ -1,51 +1,141 @@
+import math
+from array import array
 import numpy as np
 import matplotlib.pyplot as plt
+from scipy.integrate import solve_ivp
+from _sir_kernels import NUMBA_AVAILABLE, derivatives, ensemble, gillespie, rk4, seed, tau_leap
+
+# Use the ahead-of-time compiled kernels if they have been built with `python _sir_kernels.py`.
+# These run without numba and without JIT compilation at the first call
+try:
+    from sir_kernels import gillespie, rk4, tau_leap
+    from sir_kernels import seed as seed_aot
+    COMPILED = True
+except ImportError:
+    seed_aot = None
+    COMPILED = NUMBA_AVAILABLE
+
+# Smallest and largest number of random numbers generated at once by the Python Gillespie loop
+RNG_MIN_BLOCK = 64
+RNG_BLOCK = 65536
+
+# Indices of S, I, R and N in the state array and of S, I and R in the columns of the dynamics
+S_IDX = 0
+I_IDX = 1
+R_IDX = 2
+N_IDX = 3
+
+# Maximum number of time points drawn per curve, roughly the horizontal resolution of a figure
+MAX_PLOT_POINTS = 2000
+
+# Maximum number of bytes allocated at once by the ensemble kernel, about 20 bytes per stored time point
+ENSEMBLE_MEMORY = 2**28
+ENSEMBLE_BYTES_PER_POINT = 20
 
 
 class StochasticSIR:
-    def __init__(self, initial_SIR, beta, gamma, tmax):
+    # Fixed set of attributes, so instances need no __dict__. Keeps ensembles of many models small
+    __slots__ = ('current_SIR', 'SIR', 'beta', 'gamma', 'tmax', 'tau', 'N', 'inv_N', 't', 'n', 't_history', 'SIR_history',
+                 'ensemble_t', 'ensemble_SIR', 'ensemble_n')
+
+    def __init__(self, initial_SIR, beta, gamma, tmax, tau = None):
+
+        # A leap of zero or negative size never advances the time
+        if tau is not None and tau <= 0:
+            raise ValueError(f"tau must be positive, got {tau}")
+
         self.current_SIR = initial_SIR
         self.SIR = self.initialize()
         self.beta = beta
         self.gamma = gamma
-        self.t = [0]
         self.tmax = tmax
+        self.tau = tau
 
     def initialize(self):
         """
-        Changes self.current_SIR to a dictionary, each value in the original list being assigned to the corresponding key in the new dictionary, being either 'S', 'I', ''R' or 'N'.
-        Creates and returns dictionary with lists for S, I, R, and N. By default, N is the sum of the subpopulations.
+        Changes self.current_SIR to an integer array with S, I, R and N, at indices S_IDX, I_IDX, R_IDX and N_IDX.
+        Creates the arrays containing the times (self.t) and the dynamics (self.SIR), starting at t = 0.
+        Returns the array for the dynamics, with S, I and R in its columns as 32-bit integers. By default, N is the sum of the subpopulations.
+        The number of stored time points is kept in self.n.
+        Infections and recoveries do not change the population size, so N and its inverse are stored once in self.N and self.inv_N,
+        instead of with the dynamics.
         """ 
         S, I, R = self.current_SIR
-        self.current_SIR = {'S': S, 'I': I, 'R': R, 'N': S + I + R}
-        return {'S': [S], 'I': [I], 'R': [R], 'N': [S + I + R]}
+        self.N = S + I + R
+        self.inv_N = 1.0 / self.N
+        self.current_SIR = np.array([S, I, R, self.N], dtype=np.int64)
+        self.t = np.zeros(1)
+        self.SIR = np.array([[S, I, R]], dtype=np.int32)
+        self.t_history = self.SIR_history = None
+        self.n = 1
+        return self.SIR
+
+    def open_history(self):
+        """
+        Creates the compact buffers in which the Python loops append the times (self.t_history) and the dynamics (self.SIR_history),
+        starting from the arrays containing the history so far.
+        """
+
+        self.t_history = array('d', self.t.tobytes())
+        self.SIR_history = array('i', self.SIR.tobytes())
+
+    def store(self):
+        """
+        Turns the buffers with the history into the arrays containing the times (self.t) and the dynamics (self.SIR).
+        The arrays use the memory of the buffers without copying it, and the buffers themselves are dropped, so the history
+        is only held once. A next run creates new buffers with open_history.
+        """
+        self.t = np.frombuffer(self.t_history, dtype=np.float64)
+        self.SIR = np.frombuffer(self.SIR_history, dtype=np.int32).reshape(-1, 3)
+        self.t_history = self.SIR_history = None
 
     def infection_event(self):
         """
         Infection event: decreases susceptible population and increase infected population by 1
         """
         
-        self.current_SIR['S'] -= 1
-        self.current_SIR['I'] += 1
+        self.current_SIR[S_IDX] -= 1
+        self.current_SIR[I_IDX] += 1
 
     def recovery_event(self):
         """
         Recovery event: decrease infected population and increased recovered population by 1
         """
 
-        self.current_SIR['I'] -= 1
-        self.current_SIR['R'] += 1
+        self.current_SIR[I_IDX] -= 1
+        self.current_SIR[R_IDX] += 1
 
-    def update_SIR(self):
+    def update_SIR(self, new_t):
         """
-        Updates the dictionary containing the dynamics according to the most recent status of the simulation.
+        Appends the time and the most recent status of the simulation to the buffers containing the dynamics.
         """ 
 
-        S, I, R, N = self.current_SIR.values()
-        self.SIR['S'].append(S)
-        self.SIR['I'].append(I)
-        self.SIR['R'].append(R)
-        self.SIR['N'].append(S + I + R)
+        self.SIR_history.extend(self.current_SIR[:N_IDX].tolist())
+        self.t_history.append(new_t)
+        self.n += 1
+
+    def seed_kernels(self):
+        """
+        Seeds the compiled kernels with a number drawn from numpy's global generator. The kernels have their own generators,
+        so this makes compiled runs reproducible with np.random.seed, just like the Python loops.
+        The ahead-of-time compiled kernels have generators separate from the JIT kernels, so both are seeded.
+        """
+
+        s = np.random.randint(2**31)
+        seed(s)
+        if seed_aot is not None:
+            seed_aot(s)
+
+    def extend_history(self, t, SIR):
+        """
+        Appends the times and dynamics computed by a compiled kernel to the arrays containing the dynamics, leaving out their
+        first point, which is the status the kernel started from. Then updates the current status.
+        """
+
+        self.t = np.concatenate((self.t, t[1:]))
+        self.SIR = np.concatenate((self.SIR, SIR[1:]))
+        self.n = len(self.t)
+        self.current_SIR = np.append(SIR[-1], self.N).astype(np.int64)
 
     def run(self):
         """
@@ -59,78 +149,258 @@ class StochasticSIR:
         2. Calculate the probabilities of two events:
         - Event 1: A single infection.
         - Event 2: A single recovery.
-        3. Calculate the length of the current time step (dt) based on exponential distributions
-        and the sum of event probabilities.
-        4. Advance the simulation time (t) by adding dt to the previous time.
-        5. Perform either an infection event or a recovery event based on generated probabilities.
-        6. Update the dictionary containing all the disease dynamics.
+        3. Draw the waiting time until each event from an exponential distribution with the probability
+        of that event as rate.
+        4. Advance the simulation time (t) by the shortest waiting time (dt).
+        5. Perform the event with the shortest waiting time, being either an infection event or a recovery event.
+        6. Update the arrays containing all the disease dynamics.
+
+        If numba is installed or the kernels are compiled ahead of time, the loop runs in the compiled gillespie kernel.
+        If a leap size (tau) was given, the approximate tau-leaping algorithm is used instead.
         """
 
+        # Fire batches of events per step instead of single events if a leap size is given
+        if self.tau is not None:
+            return self.tau_leap()
+
+        # Run the compiled kernel if possible, continuing from the most recent time. Every infection uses up a
+        # susceptible and every recovery an infected, so there can be at most 2S + I events
+        if COMPILED:
+            self.seed_kernels()
+            S, I, R, N = self.current_SIR
+            self.extend_history(*gillespie(S, I, R, self.beta, self.gamma, self.t[-1], self.tmax, 2 * S + I + 1))
+            return
+
+        # The Python loop appends the events to compact buffers, starting from the history so far
+        self.open_history()
+
+        # Random numbers are generated in blocks of pairs of unit exponentials, one for each event
+        draws = iter(())
+        block = RNG_MIN_BLOCK // 2
+
+        # Look up attributes and methods once instead of in every step. The current status is updated in place
+        beta, gamma, tmax, inv_N = self.beta, self.gamma, self.tmax, self.inv_N
+        current_SIR = self.current_SIR
+        infection_event, recovery_event, update_SIR = self.infection_event, self.recovery_event, self.update_SIR
+        t = float(self.t[-1])
+
         # Until tmax is reached. Number of timesteps is unknown, so for-loop is not useful
-        while self.t[-1] < self.tmax:
+        while t < tmax:
 
             # Get most recent values of S, I, R and N
-            S, I, R, N = self.current_SIR.values()
+            s = current_SIR.tolist()
 
             # Stop simulation if infected population reaches zero
-            if I == 0:
+            if s[I_IDX] == 0:
                 break
 
             # Calculate probabilities of event 1 (single infection) and event 2 (single recovery)
-            probabilities = [self.beta * S * I / N, self.gamma * I]
-            probabilities_sum = sum(probabilities)
-
-            # Calculate length current timestep and add it to self.t
-            dt= np.random.exponential(scale = 1 / probabilities_sum)
-            self.t.append(self.t[-1] + dt)
-
-            # Do infection or recovery event according to probabilities
-            if np.random.uniform(0, 1) * probabilities_sum <= probabilities[0]:
+            a1 = beta * s[S_IDX] * s[I_IDX] * inv_N
+            a2 = gamma * s[I_IDX]
+
+            # Get next pair of random numbers, generate a new block if all are used. The blocks double in size, so short
+            # runs do not generate many unused numbers, and there are at most 2S + I events left
+            try:
+                e1, e2 = next(draws)
+            except StopIteration:
+                block = min(2 * block, RNG_BLOCK, 2 * s[S_IDX] + s[I_IDX])
+                draws = zip(np.random.standard_exponential(block).tolist(), np.random.standard_exponential(block).tolist())
+                e1, e2 = next(draws)
+
+            # Calculate waiting times of both events. An event with probability zero never happens, e.g. no infection
+            # can happen anymore if S is zero
+            t_inf = e1 / a1 if a1 > 0 else math.inf
+            t_rec = e2 / a2 if a2 > 0 else math.inf
+
+            # Stop simulation if neither event can happen anymore
+            if t_inf == math.inf and t_rec == math.inf:
+                break
 
-                # 1 susceptible becomes infected
-                self.infection_event()
+            # 1 susceptible becomes infected if that happens first
+            if t_inf < t_rec:
+                t += t_inf
+                infection_event()
 
             # 1 infected becomes recovered
             else:
-                self.recovery_event()
+                t += t_rec
+                recovery_event()
+
+            # Update arrays containing all dynamics
+            update_SIR(t)
+
+        self.store()
+
+    def run_ensemble(self, n_reps):
+        """
+        Runs n_reps independent simulations of the SIR model using the Gillespie algorithm, all starting from the
+        current status and time. If numba is installed, the replicates are spread over all available cores.
+
+        The times and dynamics of all replicates are stored in self.ensemble_t and self.ensemble_SIR, one row per
+        replicate. The number of stored time points of each replicate is stored in self.ensemble_n; values beyond
+        that are not defined.
+
+        The kernel is seeded from np.random, but each thread of the parallel loop draws from its own generator, so the
+        ensemble is only reproducible with np.random.seed if numba runs it on a single thread.
+
+        Every replicate can have up to 2S + I + 1 time points, and the kernel allocates room for all of them, about 20
+        bytes per time point. To bound the memory use, the replicates are run in chunks of at most ENSEMBLE_MEMORY bytes
+        (at least one replicate per chunk), and each chunk is trimmed to its longest replicate before the next one runs.
+        """
+
+        if n_reps < 1:
+            raise ValueError(f"n_reps must be at least 1, got {n_reps}")
 
-            # Update dictionary containing all dynamics
-            self.update_SIR()
+        self.seed_kernels()
+        S, I, R, N = self.current_SIR
+        cap = 2 * S + I + 1
+        chunk_size = max(ENSEMBLE_MEMORY // (ENSEMBLE_BYTES_PER_POINT * cap), 1)
+
+        chunks = []
+        for start in range(0, n_reps, chunk_size):
+            t, SIR, n = ensemble(S, I, R, self.beta, self.gamma, self.t[-1], self.tmax, min(chunk_size, n_reps - start), cap)
+
+            # Copy the trimmed chunk, so the memory of the full chunk is freed before the next one is allocated
+            longest = n.max()
+            chunks.append((t[:, :longest].copy(), SIR[:, :longest].copy(), n))
+
+        # Combine the chunks, padding the shorter ones up to the longest replicate
+        longest = max(n.max() for _, _, n in chunks)
+        self.ensemble_t = np.zeros((n_reps, longest))
+        self.ensemble_SIR = np.zeros((n_reps, longest, 3), dtype=np.int32)
+        self.ensemble_n = np.concatenate([n for _, _, n in chunks])
+
+        start = 0
+        for t, SIR, n in chunks:
+            self.ensemble_t[start:start + len(n), :t.shape[1]] = t
+            self.ensemble_SIR[start:start + len(n), :t.shape[1]] = SIR
+            start += len(n)
+
+    def summarize(self, t_grid, quantiles = (0.05, 0.95)):
+        """
+        Summarizes the replicates of run_ensemble at the times in t_grid. As the dynamics only change at events, each
+        replicate is evaluated at these times by taking its status after the most recent event.
+        The replicates have different numbers of events, so they are evaluated one by one; the loop only runs over the
+        replicates, while the search over the events and the statistics are vectorized.
+        Returns the mean of S, I and R over all replicates, with shape (len(t_grid), 3), and the given quantiles of S, I
+        and R, with shape (len(quantiles), len(t_grid), 3).
+        """
+
+        t_grid = np.asarray(t_grid)
+        dynamics = np.empty((len(self.ensemble_n), len(t_grid), 3))
+
+        for r, n in enumerate(self.ensemble_n):
+
+            # Index of the most recent event at each time of the grid. Times before the start take the initial status
+            events = np.maximum(np.searchsorted(self.ensemble_t[r, :n], t_grid, side='right') - 1, 0)
+            dynamics[r] = self.ensemble_SIR[r, events]
+
+        return dynamics.mean(axis=0), np.quantile(dynamics, quantiles, axis=0)
+
+    def tau_leap(self):
+        """
+        Runs a simulation of the SIR model using tau-leaping with a fixed leap size (tau) until tmax is reached
+        or until the infected population (I) becomes zero, whichever occurs first.
+
+        Instead of a single event per step, the numbers of infections and recoveries during a leap are drawn from
+        Poisson distributions with the event probabilities multiplied by tau as means. Both numbers are clipped
+        so no subpopulation can become negative. The dynamics are stored once per leap.
+
+        If numba is installed or the kernels are compiled ahead of time, the loop runs in the compiled tau_leap kernel,
+        which draws the Poisson numbers for small means with Knuth's method.
+        """
+
+        # Run the compiled kernel if possible, continuing from the most recent time. There are at most (tmax - t0) / tau leaps
+        if COMPILED:
+            self.seed_kernels()
+            S, I, R, N = self.current_SIR
+            t0 = self.t[-1]
+            cap = max(math.ceil((self.tmax - t0) / self.tau), 0) + 2
+            self.extend_history(*tau_leap(S, I, R, self.beta, self.gamma, t0, self.tmax, self.tau, cap))
+            return
+
+        # The Python loop appends the leaps to compact buffers, starting from the history so far
+        self.open_history()
+
+        # Stoichiometry vectors of event 1 (single infection) and event 2 (single recovery). N does not change
+        v1 = np.array([-1, 1, 0, 0])
+        v2 = np.array([0, -1, 1, 0])
+
+        # Look up attributes once instead of in every leap. The current status is updated in place
+        beta, gamma, tmax, tau, inv_N = self.beta, self.gamma, self.tmax, self.tau, self.inv_N
+        current_SIR, update_SIR = self.current_SIR, self.update_SIR
+        t = float(self.t[-1])
+
+        while t < tmax:
+            S, I, R, N = current_SIR
+
+            # Stop simulation if infected population reaches zero
+            if I == 0:
+                break
+
+            # Draw number of infections and recoveries during this leap
+            k1 = min(np.random.poisson(beta * S * I * inv_N * tau), S)
+            k2 = min(np.random.poisson(gamma * I * tau), I)
+
+            # Fire all events of this leap at once
+            current_SIR += k1 * v1 + k2 * v2
+
+            # Update arrays containing all dynamics
+            t += tau
+            update_SIR(t)
+
+        self.store()
 
 
     def plot(self, ax, S = True, I = True , R = True, N = True, S_label = 'Susceptible', I_label = 'Infected', R_label = 'Recovered', label=False):
         """
         Plots the dynamics of the model as a function of time. By default, S, I, R and N are shown, but can be removed if needed.
         Takes an ax as input so the figure can be edited outside of this function. Also takes optional figure labels.
+        Long simulations are down-sampled to at most MAX_PLOT_POINTS time points, always including the last one.
         """
         if label:
             label_addition = " stochastic"
         else:
             label_addition = ""
-            
-        # If the susceptible curve is to be plotted
-        if S:
-            ax.plot(self.t, self.SIR['S'], label=f"{S_label}{label_addition}", color='blue')
 
-        # If the infected curve is to be plotted
-        if I:
-            ax.plot(self.t, self.SIR['I'], label=f"{I_label}{label_addition}", color='green')
-
-        # If the recovered curve is to be plotted
-        if R:
-            ax.plot(self.t, self.SIR['R'], label=f"{R_label}{label_addition}", color='purple')
-
-        # If the population size curve is to be plotted
-        if N:
-            ax.plot(self.t, self.SIR['N'], label=f'Population size{label_addition}', color='orange')
+        # Column, label and color of each curve, kept only if the curve is to be plotted
+        curves = [
+            (S, S_IDX, S_label, 'blue'),
+            (I, I_IDX, I_label, 'green'),
+            (R, R_IDX, R_label, 'purple'),
+            (N, N_IDX, 'Population size', 'orange'),
+        ]
+        curves = [curve for curve in curves if curve[0]]
+        if not curves:
+            return
+
+        # Take every stride-th time point, so no more than MAX_PLOT_POINTS are drawn
+        stride = math.ceil(self.n / MAX_PLOT_POINTS)
+        points = np.arange(0, self.n, stride)
+        if points[-1] != self.n - 1:
+            points = np.append(points, self.n - 1)
+
+        # N is constant and not stored with the dynamics, so it is added as extra column
+        dynamics = np.column_stack([self.SIR[points], np.full(len(points), self.N)])
+
+        # Plot all curves at once and style them afterwards
+        columns = [curve[1] for curve in curves]
+        lines = ax.plot(self.t[points], dynamics[:, columns])
+        for line, (_, _, curve_label, color) in zip(lines, curves):
+            line.set_label(f"{curve_label}{label_addition}")
+            line.set_color(color)
 
 
 class ContinuousSIR:
-    def __init__(self, initial_SIR, tmax, dt, beta, gamma, population_size = 1000):
+    # Fixed set of attributes, so instances need no __dict__
+    __slots__ = ('beta', 'gamma', 'tmax', 'dt', 'method', 'population_size', 'n_points', 't', 'sir')
+
+    def __init__(self, initial_SIR, tmax, dt, beta, gamma, population_size = 1000, method = 'RK4'):
         self.beta = beta
         self.gamma = gamma
         self.tmax = tmax
         self.dt = dt
+        self.method = method
         self.population_size = population_size
         self.n_points = int(tmax/dt)
         self.t = np.linspace(0, self.tmax, self.n_points)
@@ -148,38 +418,41 @@ class ContinuousSIR:
 
     def get_derivatives(self, y):
         """
-        Calculates the time derivative of S, I, and R in the SIR model according to the current values of S I and R, and the values of beta, gamma, mu, nu and rho.
+        Calculates the time derivative of S, I, and R in the SIR model according to the current values of S I and R, and the values of beta and gamma.
+        Uses the same derivatives kernel as the Runge-Kutta loop in run().
         """
 
         # Unpack parameters from array
         S, I, R, N = y
-        
-        dS = - self.beta * S * I
-        dI = self.beta * S * I - self.gamma * I
-        dR = self.gamma * I
-        dN = dS + dI + dR
+        dS, dI, dR = derivatives(S, I, self.beta, self.gamma)
 
-        # Return array with values for the time derivatives of S, I, and R. Sets value for N to 0, this will be calculated and adjusted in run()
-        return np.array([dS, dI, dR, dN])
+        # Return array with values for the time derivatives of S, I, R and N. The derivative of N is always 0
+        return np.array([dS, dI, dR, dS + dI + dR])
 
     def run(self):
         """
         Solves the set of differential equations of the SIR model according to the 4th order Runge-Kutta method.
+        The Runge-Kutta steps are done on scalars in the rk4 kernel, which is compiled if numba is installed or if
+        the kernels are compiled ahead of time.
+
+        If another method is given (e.g. 'RK45'), the equations are solved by scipy's solve_ivp with adaptive step size
+        instead, and the solution is evaluated at the times in self.t.
         """
 
-        # For each timestep
-        for i in range(len(self.t) - 1):
+        if self.method == 'RK4':
+            rk4(self.sir, self.dt, self.beta, self.gamma, len(self.t))
+            return self.sir
+
+        sol = solve_ivp(lambda t, y: self.get_derivatives(y), (0, self.t[-1]), self.sir[0], method=self.method, t_eval=self.t, rtol=1e-6)
+
+        # A failed solver only returns the solution up to where it stopped
+        if not sol.success:
+            raise RuntimeError(f"solve_ivp with method {self.method} failed: {sol.message}")
 
-            # Do timestep according to Runge-Kutta 4th order
-            y = self.sir[i]
-            k_1 = self.dt * self.get_derivatives(y)
-            k_2 = self.dt * self.get_derivatives(y + k_1 / 2.)
-            k_3 = self.dt * self.get_derivatives(y + k_2 / 2.)
-            k_4 = self.dt * self.get_derivatives(y + k_3)
+        self.sir[:, :3] = sol.y[:3].T
 
-            # Update values for S, I, R and N
-            self.sir[i+1] = y + 1/6 * (k_1 + 2 * k_2 + 2 * k_3 + k_4)
-            
+        # The derivatives sum to zero, so N does not change. Copied to avoid rounding errors of the solver
+        self.sir[:, 3] = self.sir[0, 3]
         return self.sir
 
     def plot(self, ax, S = True, I = True , R = True, N = True, S_label = 'Susceptible', I_label = 'Infected', R_label = 'Recovered'):